@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+# Benchmark of main() time-to-first-request, run as a cron job would.
+# It fails when the first curl call takes longer than the budget,
+# or when geojson or zipfile were imported before it.
+# Usage: python bench_startup.py [budget_ms]
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+
+t_start = time.perf_counter()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import peps_download
+
+# Time budget from the start of the script to the first catalog request
+BUDGET_MS = 250
+
+# Dependencies which the first request must not need
+LAZY_MODULES = ['geojson', 'zipfile']
+
+
+class FirstRequest(Exception):
+    pass
+
+
+def _first_request(cmd):
+    raise FirstRequest([name for name in LAZY_MODULES if name in sys.modules])
+
+
+def main(args):
+    budget_ms = float(args[0]) if len(args) > 0 else BUDGET_MS
+    cwd = os.getcwd()
+    elapsed_ms = None
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        with open('peps_config.yaml', 'w') as f:
+            f.write("peps:\n  user: user@example.com\n  password: secret\n")
+
+        # Collection S2 after 2016-12-05 takes the date warning path
+        peps_download.os.system = _first_request
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            peps_download.main(['-c', 'S2', '-l', 'Toulouse', '-a', 'peps_config.yaml',
+                                '-d', '2017-01-01', '-f', '2017-02-01', '-w', work_dir])
+        except FirstRequest as e:
+            elapsed_ms = (time.perf_counter() - t_start) * 1000
+            imported = e.args[0]
+        finally:
+            sys.stdout = stdout
+            for handler in logging.root.handlers[:]:
+                handler.close()
+                logging.root.removeHandler(handler)
+            os.chdir(cwd)
+
+    if elapsed_ms is None:
+        print("main() returned without any catalog request")
+        sys.exit(-1)
+    print("time to first request: {:.1f} ms (budget {:.0f} ms)".format(elapsed_ms, budget_ms))
+    if len(imported) > 0:
+        print("Imported before the first request: {}".format(", ".join(imported)))
+        sys.exit(-1)
+    if elapsed_ms > budget_ms:
+        print("Time to first request is over budget")
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
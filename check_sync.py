@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+# Checks of the sync mode high-water mark, with curl replaced by a fake PEPS.
+# It fails when one of the checks does not hold.
+# Usage: python check_sync.py
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import peps_download
+
+SYNC_INTERVAL = 3600
+PRODUCT_SIZE = 10
+
+
+class StopSync(Exception):
+    pass
+
+
+class Options:
+    """Options as given by ParserConfig, for a sync on a location"""
+
+    def __init__(self, write_dir, end_date=date(2020, 2, 1)):
+        self.tile = None
+        self.geojson = None
+        self.location = 'Toulouse'
+        self.lat = None
+        self.lon = None
+        self.latmin = None
+        self.latmax = None
+        self.lonmin = None
+        self.lonmax = None
+        self.write_dir = write_dir
+        self.collection = 'S1'
+        self.product_type = 'GRD'
+        self.sensor_mode = None
+        self.no_download = False
+        self.start_date = date(2020, 1, 1)
+        self.end_date = end_date
+        self.clouds = 100
+        self.windows = False
+        self.extract = False
+        self.search_json_file = None
+        self.sat = None
+        self.orbit = None
+        self.log = 'peps_download.log'
+        self.auth = 'peps_config.yaml'
+        self.sync = True
+        self.sync_interval = SYNC_INTERVAL
+        self.sync_state = None
+
+
+def feature(n, published):
+    return {"id": "id{}".format(n),
+            "properties": {"productIdentifier": "P{}".format(n),
+                           "storage": {"mode": "disk"}, "platform": "S1A",
+                           "resourceSize": PRODUCT_SIZE, "orbitNumber": 1,
+                           "published": published}}
+
+
+def run_sync(cycles, search, download=None, end_date=date(2020, 2, 1)):
+    """Run the sync for some cycles against a fake PEPS.
+
+    search(cycle, page, cmd) returns the features of a search page, or None for a failed search.
+    download(cycle, prod) returns False for a truncated download, or a text answer.
+    Return the search commands of each cycle and the sync state.
+    """
+    searches = [[] for _ in range(cycles)]
+    cycle = [0]
+    ids = {}
+
+    def fake_system(cmd):
+        out = cmd.split('-o ')[1].split()[0]
+        if 'search.json' in cmd:
+            searches[cycle[0]].append(cmd)
+            page = re.search(r'page=(\d+)', cmd)
+            features = search(cycle[0], int(page.group(1)), cmd)
+            published_begin = re.search(r'publishedBegin=([^\\\s]+)', cmd)
+            if features is not None and published_begin is not None:
+                features = [each for each in features
+                            if each['properties']['published'] >= published_begin.group(1)]
+            if features is not None:
+                for each in features:
+                    ids[each['id']] = each['properties']['productIdentifier']
+                with open(out, 'w') as f:
+                    json.dump({"features": features}, f)
+        else:
+            prod = ids[cmd.split('/download')[0].split('/')[-1]]
+            data = b'\x00' * PRODUCT_SIZE
+            if download is not None:
+                answer = download(cycle[0], prod)
+                if answer is False:
+                    data = data[:PRODUCT_SIZE // 2]
+                elif answer is not True:
+                    data = answer.encode()
+            with open(out, 'wb') as f:
+                f.write(data)
+        return 0
+
+    def fake_sleep(seconds):
+        if seconds == SYNC_INTERVAL:
+            cycle[0] += 1
+            if cycle[0] == cycles:
+                raise StopSync
+
+    system, sleep = peps_download.os.system, peps_download.time.sleep
+    peps_download.os.system, peps_download.time.sleep = fake_system, fake_sleep
+    options = Options('out', end_date)
+    try:
+        peps_download.peps_downloader(options)
+    except StopSync:
+        pass
+    finally:
+        peps_download.os.system, peps_download.time.sleep = system, sleep
+        for handler in logging.root.handlers[:]:
+            handler.close()
+            logging.root.removeHandler(handler)
+
+    state = {}
+    if os.path.exists(options.sync_state):
+        with open(options.sync_state) as f:
+            state = json.load(f)
+    return searches, state
+
+
+def check_complete_cycle():
+    # The mark advances after a complete cycle, and the product at the mark is dropped
+    def search(cycle, page, cmd):
+        return [feature(1, "2020-01-01T00:00:00Z"), feature(2, "2020-01-02T00:00:00Z")]
+
+    searches, state = run_sync(2, search)
+    assert list(state.values()) == ["2020-01-02T00:00:00Z"], state
+    assert 'publishedBegin=2020-01-02T00:00:00Z' in searches[1][0], searches[1]
+    # Nothing new in the second cycle, so no redo search
+    assert len(searches[1]) == 1, searches[1]
+
+
+def check_failed_page():
+    # A failed page keeps the mark
+    def search(cycle, page, cmd):
+        if page == 1:
+            return [feature(n, "2020-01-01T00:00:00Z") for n in range(peps_download._MAX_RECORDS)]
+        return None
+
+    searches, state = run_sync(2, search)
+    assert state == {}, state
+    assert 'publishedBegin' not in searches[1][0], searches[1]
+
+
+def check_unsaved_products():
+    # The mark stays below the oldest product which was not saved
+    def search(cycle, page, cmd):
+        return [feature(1, "2020-01-01T00:00:00Z"), feature(2, "2020-01-02T00:00:00Z"),
+                feature(3, "2020-01-03T00:00:00Z")]
+
+    def download(cycle, prod):
+        return prod != 'P2'
+
+    searches, state = run_sync(1, search, download)
+    assert list(state.values()) == ["2020-01-01T00:00:00Z"], state
+    assert sorted(os.listdir('out')) == ['P1.zip', 'P3.zip'], os.listdir('out')
+
+
+def check_wrong_password():
+    # An authentication failure stops the sync instead of being retried
+    def search(cycle, page, cmd):
+        return [feature(1, "2020-01-01T00:00:00Z")]
+
+    def download(cycle, prod):
+        return '{"ErrorMessage": "Unauthorized"}'
+
+    try:
+        run_sync(2, search, download)
+    except SystemExit:
+        return
+    raise AssertionError("sync went on after a wrong password")
+
+
+def check_open_end_date():
+    # An open end date follows today and is not part of the sync key
+    def search(cycle, page, cmd):
+        return [feature(1, "2020-01-01T00:00:00Z")]
+
+    searches, state = run_sync(1, search, end_date=None)
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    assert 'completionDate={}'.format(tomorrow) in searches[0][0], searches[0]
+    assert '"open"' in list(state.keys())[0], state
+
+
+def main(args):
+    checks = [check_complete_cycle, check_failed_page,
+              check_unsaved_products, check_wrong_password, check_open_end_date]
+    cwd = os.getcwd()
+    failed = 0
+    for check in checks:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            with open('peps_config.yaml', 'w') as f:
+                f.write("peps:\n  user: user@example.com\n  password: secret\n")
+            try:
+                check()
+            except AssertionError as e:
+                failed += 1
+                print("{} failed: {}".format(check.__name__, e))
+            else:
+                print("{} passed".format(check.__name__))
+            finally:
+                os.chdir(cwd)
+
+    if failed > 0:
+        sys.exit(-1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
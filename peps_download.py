@@ -1,17 +1,22 @@
 #! /usr/bin/env python
 # -*- coding: iso-8859-1 -*-
+# geojson and zipfile are only imported on the geojson query and extraction
+# paths. yaml is imported by parse_config, which every download run calls.
 import json
 import time
 import os
 import os.path
 import optparse
 import sys
-import yaml
-import geojson
-import zipfile
 import logging
 from os.path import exists
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+
+# First day of the Sentinel-2 tiled products collection (S2ST)
+_S2ST_START_DATE = date(2016, 12, 5)
+
+# Number of products per page of catalog search
+_MAX_RECORDS = 500
 
 
 class OptionParser(optparse.OptionParser):
@@ -74,7 +79,8 @@ class ParserConfig:
             self.tile = config['tile']
         elif config['geojson'] is not None:
             print("Use geojson for query.")
-            print("Warning: if the single feature is too big, only 500 imagery will be back.")
+            print("Warning: if the single feature is too big, only 500 imagery will be back "
+                  "(sync mode pages through all of them).")
             print("Suggestion: use a small geojson each time.")
             self.geojson = config['geojson']
         elif config['bbox'] is not None:
@@ -112,6 +118,14 @@ class ParserConfig:
         self.sat = config['satellite']
         self.orbit = config['orbit']
 
+        # Set incremental sync
+        self.sync = bool(config.get('sync'))
+        self.sync_state = config.get('sync_state')
+        if config.get('sync_interval') is None:
+            self.sync_interval = 3600
+        else:
+            self.sync_interval = config['sync_interval']
+
         # Set logging
         if config['log_dir'] is not None:
             self.log = "{}/peps_download_{}.log"\
@@ -123,14 +137,85 @@ class ParserConfig:
 
 
 def parse_config(auth_file_path):
+    import yaml
     with open(auth_file_path, 'r') as yaml_file:
         config = yaml.safe_load(yaml_file)
         return config
 
 
-def _query_catalog(options, query_geom, start_date, end_date, logger):
+def _pause_for_warning():
+    # Give interactive users time to read a warning, cron jobs need not wait
+    if sys.stdout.isatty():
+        time.sleep(5)
+
+
+def _search_pages(options, query_geom, start_date, end_date, published_filter, json_file, logger):
+    # Search the catalog, page by page in sync mode so no product is left out of a large result.
+    # Return the gathered features and the error json of the failed page, if any.
+    features = []
+    ids = set()
+    page = 1
+    while True:
+        if (options.product_type is None) and (options.sensor_mode is None):
+            search_catalog = "curl -k -o {} https://peps.cnes.fr/resto/api/" \
+                             "collections/{}/search.json?{}\&startDate={}" \
+                             "\&completionDate={}\&maxRecords={}" \
+                .format(json_file, options.collection,
+                        query_geom, start_date, end_date, _MAX_RECORDS)
+        else:
+            product_type = "" if options.product_type is None else options.product_type
+            sensor_mode = "" if options.sensor_mode is None else options.sensor_mode
+            search_catalog = 'curl -k -o {} https://peps.cnes.fr/resto/api/' \
+                             'collections/{}/search.json?{}\&startDate={}' \
+                             '\&completionDate={}\&maxRecords={}' \
+                             '\&productType={}\&sensorMode={}' \
+                .format(json_file, options.collection,
+                        query_geom, start_date, end_date, _MAX_RECORDS,
+                        product_type, sensor_mode)
+        if options.sync:
+            search_catalog += "\&page={}".format(page)
+        search_catalog += published_filter
+
+        if options.windows:
+            search_catalog = search_catalog.replace('\&', '^&')
+
+        logger.info(search_catalog)
+        if os.path.exists(json_file):
+            os.remove(json_file)
+        os.system(search_catalog)
+        time.sleep(5)
+
+        try:
+            with open(json_file) as data_file:
+                data = json.load(data_file)
+            os.remove(json_file)
+        except (IOError, ValueError) as e:
+            return features, {"ErrorCode": -1,
+                              "ErrorMessage": "No valid search result: {}".format(e)}
+        if 'ErrorCode' in data:
+            return features, data
+
+        new_features = [each for each in data['features'] if each['id'] not in ids]
+        if len(data['features']) > 0 and len(new_features) == 0:
+            return features, {"ErrorCode": -1,
+                              "ErrorMessage": "Page {} repeats previous results".format(page)}
+        ids.update(each['id'] for each in new_features)
+        features.extend(new_features)
+        if not options.sync or len(data['features']) < _MAX_RECORDS:
+            return features, None
+        page += 1
+
+
+def _query_catalog(options, query_geom, start_date, end_date, logger, published_begin=None):
+    # Only ask for products published since the high-water mark, if any
+    if published_begin is None:
+        published_filter = ""
+    else:
+        published_filter = "\&publishedBegin={}".format(published_begin)
+
     # Parse catalog
     # If the query geom is a geojson with more than 1 feature
+    complete = True
     if isinstance(query_geom, list):
         logger.info('Query based on geojson with multiple features.')
         json_file_tmp = 'tmp.json'
@@ -146,69 +231,43 @@ def _query_catalog(options, query_geom, start_date, end_date, logger):
             query_geom_each = 'box={lonmin},{latmin},{lonmax},{latmax}' \
                 .format(latmin=latmin, latmax=latmax,
                         lonmin=lonmin, lonmax=lonmax)
-            if (options.product_type is None) and (options.sensor_mode is None):
-                search_catalog = "curl -k -o {} https://peps.cnes.fr/resto/api/" \
-                                 "collections/{}/search.json?{}\&startDate={}" \
-                                 "\&completionDate={}\&maxRecords=500" \
-                    .format(json_file_tmp, options.collection,
-                            query_geom_each, start_date, end_date)
-            else:
-                product_type = "" if options.product_type is None else options.product_type
-                sensor_mode = "" if options.sensor_mode is None else options.sensor_mode
-                search_catalog = 'curl -k -o {} https://peps.cnes.fr/resto/api/' \
-                                 'collections/{}/search.json?{}\&startDate={}' \
-                                 '\&completionDate={}\&maxRecords=500' \
-                                 '\&productType={}\&sensorMode={}' \
-                    .format(json_file_tmp, options.collection,
-                            query_geom_each, start_date, end_date,
-                            product_type, sensor_mode)
-            if options.windows:
-                search_catalog = search_catalog.replace('\&', '^&')
-            os.system(search_catalog)
-            time.sleep(5)
-
-            with open(json_file_tmp) as data_file:
-                json_each = json.load(data_file)
-                if 'ErrorCode' in json_each:
-                    logger.error("Error in query of {}th feature: {}"
-                                 .format(i, json_each['ErrorMessage']))
-                else:
-                    for n in range(0, len(json_each['features'])):
-                        json_each['features'][n]['properties']['no_geom'] = i
-                    json_all['features'].extend(json_each['features'])
-            os.remove(json_file_tmp)
-
-        # Write json_all as search_json_file
-        with open(options.search_json_file, 'w') as f:
-            json.dump(json_all, f)
-        logger.info("Write gathered search json to {}.".format(options.search_json_file))
+            features, error = _search_pages(options, query_geom_each, start_date, end_date,
+                                            published_filter, json_file_tmp, logger)
+            if error is not None:
+                logger.error("Error in query of {}th feature: {}"
+                             .format(i, error['ErrorMessage']))
+                complete = False
+            for n in range(0, len(features)):
+                features[n]['properties']['no_geom'] = i
+            json_all['features'].extend(features)
 
     # Regular condition
     else:
         logger.info("Query based on regular conditions.")
-        if (options.product_type is None) and (options.sensor_mode is None):
-            search_catalog = "curl -k -o {} https://peps.cnes.fr/resto/api/" \
-                             "collections/{}/search.json?{}\&startDate={}" \
-                             "\&completionDate={}\&maxRecords=500" \
-                .format(options.search_json_file, options.collection,
-                        query_geom, start_date, end_date)
+        features, error = _search_pages(options, query_geom, start_date, end_date,
+                                        published_filter, options.search_json_file, logger)
+        if error is not None and not options.sync:
+            # Let parse_catalog report the error
+            json_all = error
         else:
-            product_type = "" if options.product_type is None else options.product_type
-            sensor_mode = "" if options.sensor_mode is None else options.sensor_mode
-            search_catalog = 'curl -k -o {} https://peps.cnes.fr/resto/api/' \
-                             'collections/{}/search.json?{}\&startDate={}' \
-                             '\&completionDate={}\&maxRecords=500' \
-                             '\&productType={}\&sensorMode={}' \
-                .format(options.search_json_file, options.collection,
-                        query_geom, start_date, end_date,
-                        product_type, sensor_mode)
-
-        if options.windows:
-            search_catalog = search_catalog.replace('\&', '^&')
-
-        logger.info(search_catalog)
-        os.system(search_catalog)
-        time.sleep(5)
+            if error is not None:
+                # Keep the pages gathered before the error, the sync mark stays in place
+                logger.error("Error in query: {}".format(error['ErrorMessage']))
+                complete = False
+            json_all = {"type": "FeatureCollection",
+                        "properties": {},
+                        "features": features}
+
+    # The mark itself is inclusive, drop the products already seen at it
+    if published_begin is not None and 'features' in json_all:
+        json_all['features'] = [each for each in json_all['features']
+                                if each['properties'].get('published') != published_begin]
+
+    # Write json_all as search_json_file
+    with open(options.search_json_file, 'w') as f:
+        json.dump(json_all, f)
+    logger.info("Write gathered search json to {}.".format(options.search_json_file))
+    return complete
 
 
 def check_rename(tmpfile, options, prod, prodsize, logger):
@@ -230,6 +289,7 @@ def check_rename(tmpfile, options, prod, prodsize, logger):
 
     # Unzip file
     if options.extract and os.path.exists(zfile):
+        import zipfile
         try:
             with zipfile.ZipFile(zfile, 'r') as zf:
                 safename = zf.namelist()[0].replace('/', '')
@@ -251,7 +311,7 @@ def check_rename(tmpfile, options, prod, prodsize, logger):
     logger.info("Product saved as : " + zfile)
 
 
-def parse_catalog(options, logger):
+def parse_catalog(options, logger, allow_empty=False):
     # Filter catalog result
     with open(options.search_json_file) as data_file:
         data = json.load(data_file)
@@ -339,6 +399,9 @@ def parse_catalog(options, logger):
 
         for prod in download_dict.keys():
             logger.info("{} {}".format(prod, storage_dict[prod]))
+    elif allow_empty:
+        logger.info("No new product corresponds to selection criteria")
+        return None, download_dict, storage_dict, size_dict
     else:
         logger.warning("No product corresponds to selection criteria")
         sys.exit(-1)
@@ -346,6 +409,56 @@ def parse_catalog(options, logger):
     return prod, download_dict, storage_dict, size_dict
 
 
+def _catalog_products(options):
+    # Get the publication date and storage mode of each product in the search catalog
+    with open(options.search_json_file) as data_file:
+        data = json.load(data_file)
+    products = {}
+    for each in data.get('features', []):
+        storage = each['properties'].get('storage', {}).get('mode')
+        products[each['properties']['productIdentifier']] = \
+            (each['properties'].get('published'), storage)
+    return products
+
+
+def _next_mark(published_begin, published, unsaved):
+    # Move the high-water mark to the latest publication date,
+    # but stay below the oldest product which was not saved, so it is searched again
+    pending = [published[prod] for prod in unsaved if published.get(prod) is not None]
+    candidates = [each for each in published.values() if each is not None]
+    if len(pending) > 0:
+        candidates = [each for each in candidates if each < min(pending)]
+    if published_begin is not None:
+        candidates = [each for each in candidates if each > published_begin]
+    if len(candidates) == 0:
+        return published_begin
+    return max(candidates)
+
+
+def _sync_key(options, query_geom, start_date, end_date):
+    # Identify a query by every setting which selects the products,
+    # so changing any of them starts again from the whole date window.
+    # An open end date follows today and stays the same query.
+    return json.dumps([options.collection, options.product_type,
+                       options.sensor_mode, query_geom,
+                       str(start_date), "open" if end_date is None else str(end_date),
+                       options.sat, options.orbit, options.clouds])
+
+
+def _read_sync_state(options):
+    if not os.path.exists(options.sync_state):
+        return {}
+    with open(options.sync_state) as f:
+        return json.load(f)
+
+
+def _write_sync_state(options, state):
+    tmp_state = "{}.tmp".format(options.sync_state)
+    with open(tmp_state, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_state, options.sync_state)
+
+
 def peps_downloader(options):
     # Set up logger
     for handler in logging.root.handlers[:]:
@@ -363,6 +476,10 @@ def peps_downloader(options):
     if options.search_json_file is None or options.search_json_file == "":
         options.search_json_file = 'search.json'
 
+    # Initialize state file for incremental sync
+    if options.sync and (options.sync_state is None or options.sync_state == ""):
+        options.sync_state = 'peps_sync_state.json'
+
     if options.sat is not None:
         logger.info("{} {}".format(options.sat, options.collection[0:2]))
         if not options.sat.startswith(options.collection[0:2]):
@@ -422,6 +539,7 @@ def peps_downloader(options):
             sys.exit(-4)
         query_geom = "tileid={}".format(tileid)
     elif geom == 'geojson':
+        import geojson
         with open(options.geojson) as f:
             gj = geojson.load(f)
         if len(gj['features']) > 1:
@@ -454,32 +572,32 @@ def peps_downloader(options):
 
     # special case for Sentinel-2
     if options.collection == 'S2':
-        if options.start_date >= datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        if options.start_date >= _S2ST_START_DATE:
             print("**** Products after '2016-12-05' are stored in Tiled products collection")
             print("**** Please use option -c S2ST")
             logger.warning("Option -c S2ST should be used for sentinel-2 imagery after '2016-12-05'")
-            time.sleep(5)
-        elif options.end_date >= datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+            _pause_for_warning()
+        elif options.end_date >= _S2ST_START_DATE:
             print("**** Products after '2016-12-05' are stored in Tiled products collection")
             print("**** Please use option -c S2ST to get the products after that date")
             print("**** Products before that date will be downloaded")
             logger.warning("Option -c S2ST should be used for sentinel-2 imagery after '2016-12-05'. "
                            "Products before that date will be downloaded")
-            time.sleep(5)
+            _pause_for_warning()
 
     if options.collection == 'S2ST':
-        if options.end_date < datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+        if options.end_date < _S2ST_START_DATE:
             print("**** Products before '2016-12-05' are stored in non-tiled products collection")
             print("**** Please use option -c S2")
             logger.warning("Option -c S2 should be used for sentinel-2 imagery before '2016-12-05'")
-            time.sleep(5)
-        elif options.start_date < datetime.strptime('2016-12-05', '%Y-%m-%d').date():
+            _pause_for_warning()
+        elif options.start_date < _S2ST_START_DATE:
             print("**** Products before '2016-12-05' are stored in non-tiled products collection")
             print("**** Please use option -c S2 to get the products before that date")
             print("**** Products after that date will be downloaded")
             logger.warning("Option -c S2 should be used for sentinel-2 imagery before '2016-12-05'. "
                            "Products after that date will be downloaded")
-            time.sleep(5)
+            _pause_for_warning()
 
     # ====================
     # read authentication file
@@ -493,17 +611,30 @@ def peps_downloader(options):
         sys.exit(-1)
 
     # ====================
-    # search in catalog
+    # search in catalog and download
     # ====================
+    if options.sync:
+        _sync_catalog(options, query_geom, start_date, options.end_date, email, passwd, logger)
+    else:
+        _download_catalog(options, query_geom, start_date, end_date, email, passwd, logger)
+
+
+def _download_catalog(options, query_geom, start_date, end_date, email, passwd, logger,
+                      published_begin=None, allow_empty=False):
     # Clean search json file
     if os.path.exists(options.search_json_file):
         os.remove(options.search_json_file)
 
     # Parse catalog
-    _query_catalog(options, query_geom, start_date, end_date, logger)
+    complete = _query_catalog(options, query_geom, start_date, end_date, logger, published_begin)
 
     # Read catalog
-    prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
+    prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger, allow_empty)
+    products = _catalog_products(options)
+    published = dict((prod, products[prod][0]) for prod in products)
+    # Products with "unknown" storage are not downloaded, but are still expected
+    expected = set(download_dict.keys()) | \
+        set(prod for prod in products if products[prod][1] == "unknown")
 
     # ====================
     # Download
@@ -538,8 +669,9 @@ def peps_downloader(options):
         while NbProdsToDownload > 0:
             # redo catalog search to update disk/tape status
             logger.info("Redo catalog search to update disk/tape status.")
-            _query_catalog(options, query_geom, start_date, end_date, logger)
-            prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger)
+            complete = _query_catalog(options, query_geom, start_date, end_date,
+                                      logger, published_begin) and complete
+            prod, download_dict, storage_dict, size_dict = parse_catalog(options, logger, allow_empty)
 
             NbProdsToDownload = 0
             # download all products on disk
@@ -580,6 +712,58 @@ def peps_downloader(options):
                             .format(NbProdsToDownload))
                 time.sleep(60)
 
+    # Products which were expected but not saved
+    if options.no_download:
+        unsaved = []
+    else:
+        unsaved = [prod for prod in expected
+                   if not (os.path.exists("{}/{}.SAFE".format(options.write_dir, prod)) or
+                           os.path.exists("{}/{}.zip".format(options.write_dir, prod)))]
+    return published, unsaved, complete
+
+
+def _sync_catalog(options, query_geom, start_date, end_date, email, passwd, logger):
+    # Keep a high-water mark of publication date per query,
+    # so each cycle only asks PEPS for newly published products.
+    key = _sync_key(options, query_geom, start_date, end_date)
+    while True:
+        # A failed search or download keeps the high-water mark and is retried on the next cycle.
+        # Other errors, like a wrong password, stop the sync.
+        try:
+            state = _read_sync_state(options)
+            published_begin = state.get(key)
+            if published_begin is None:
+                logger.info("No high-water mark for this query, search the whole date window.")
+            else:
+                logger.info("Search products published since {}.".format(published_begin))
+
+            # An open end date is the end of today, at each cycle
+            if end_date is None:
+                cycle_end_date = (date.today() + timedelta(days=1)).isoformat()
+            else:
+                cycle_end_date = end_date
+
+            published, unsaved, complete = _download_catalog(options, query_geom, start_date,
+                                                             cycle_end_date, email, passwd, logger,
+                                                             published_begin=published_begin,
+                                                             allow_empty=True)
+            if len(unsaved) > 0:
+                logger.warning("{} products were not saved, they will be searched again: {}"
+                               .format(len(unsaved), ", ".join(sorted(unsaved))))
+
+            mark = _next_mark(published_begin, published, unsaved)
+            if not complete:
+                logger.warning("Search result is incomplete, keep high-water mark.")
+            elif mark != published_begin:
+                state[key] = mark
+                _write_sync_state(options, state)
+                logger.info("Update high-water mark to {}.".format(mark))
+        except (OSError, ValueError) as e:
+            logger.error("Sync cycle failed, keep high-water mark: {}".format(e))
+
+        logger.info("Wait {} seconds before next sync.".format(options.sync_interval))
+        time.sleep(options.sync_interval)
+
 
 # The function also could be called like this:
 # options = ParserConfig('peps_config.yaml')
@@ -660,6 +844,12 @@ def main(args):
                           help="S1A, S1B, S2A, S2B, S3A, S3B", default=None)
         parser.add_option("-x", "--extract", dest="extract", action="store_true",
                           help="Extract and remove zip file after download")
+        parser.add_option("--sync", dest="sync", action="store_true",
+                          help="Keep running and only fetch products published since last cycle", default=False)
+        parser.add_option("--sync_interval", dest="sync_interval", action="store", type="int",
+                          help="Seconds to wait between two sync cycles", default=3600)
+        parser.add_option("--sync_state", dest="sync_state", action="store", type="string",
+                          help="Path of the json file keeping the sync high-water marks", default=None)
         parser.add_option("--ld", "--log_dir", dest="log_dir", action="store_true",
                           help="The path to save log file", default=None)
         (options, _) = parser.parse_args(args)